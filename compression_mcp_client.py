@@ -5,18 +5,78 @@ Created: 2025-05-28
 Purpose: Interface with the compression MCP server for token management
 """
 
+import re
 import json
+import time
 import asyncio
-from typing import Dict, List, Optional, Any
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Any
 from datetime import datetime
+from hashlib import blake2b
+
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib json module
+    orjson = None
+
+# Keywords used by the mock conversation compressor
+_DECISION_KW = ('decision', 'decided')
+_ACTION_KW = ('implement', 'build', 'create')
+# Single-pass, case-insensitive matchers for the keywords above. re.ASCII
+# keeps matching in line with str.lower(); Unicode case folding would also
+# accept look-alikes such as 'ſ' (long s) or dotless 'ı'.
+_CASE_FLAGS = re.IGNORECASE | re.ASCII
+_DECISION_RE = re.compile('|'.join(_DECISION_KW), _CASE_FLAGS)
+_ACTION_RE = re.compile('|'.join(_ACTION_KW), _CASE_FLAGS)
+_KEYWORD_RE = re.compile('|'.join(_DECISION_KW + _ACTION_KW), _CASE_FLAGS)
+
+# Caps applied to the extracted lists in compress_conversation
+_MAX_KEY_POINTS = 5
+_MAX_DECISIONS = 3
+
+# Timestamps are reused for calls made within this window (seconds)
+_TIMESTAMP_GRANULARITY = 0.05
+
+# Limits for the compress_text result cache: entry count, total length of
+# the cached compressed texts, and the largest input that is cached at all.
+# Worst case the cache holds about _COMPRESS_CACHE_MAX_CHARS characters.
+_COMPRESS_CACHE_SIZE = 1024
+_COMPRESS_CACHE_MAX_CHARS = 4 * 1024 * 1024
+_COMPRESS_CACHE_MAX_TEXT = 64 * 1024
+
+# Maximum number of conversations tracked for incremental suggestion scans
+_SUGGEST_CACHE_SIZE = 64
 
 
 class CompressionMCPClient:
     """Client for interacting with the Compression MCP Server"""
     
+    __slots__ = ('connected', 'mock_mode', 'deterministic', '_compress_cache',
+                 '_compress_cache_chars', '_suggest_cache', '_ts_cache', '_ts_epoch')
+    
     def __init__(self):
         self.connected = False
         self.mock_mode = True  # Start in mock mode until MCP is available
+        self._ts_cache = ''
+        self._ts_epoch = float('-inf')
+        # Return byte-identical results for repeated inputs so upstream
+        # prompt caches stay valid
+        self.deterministic = True
+        self._compress_cache: 'OrderedDict[tuple, Dict[str, Any]]' = OrderedDict()
+        self._compress_cache_chars = 0  # Total length of cached compressed texts
+        # id(conversation) -> (messages seen, word count, suggestions,
+        #                      first message seen, last message seen)
+        self._suggest_cache: 'OrderedDict[int, tuple]' = OrderedDict()
+        
+    def _now_iso(self) -> str:
+        """Return the current ISO timestamp, cached for bursts of calls"""
+        # The window is timed on the monotonic clock so a wall-clock step
+        # backwards can't freeze the cached value
+        now = time.monotonic()
+        if now - self._ts_epoch > _TIMESTAMP_GRANULARITY:
+            self._ts_cache = datetime.now().isoformat()
+            self._ts_epoch = now
+        return self._ts_cache
         
     async def connect(self) -> bool:
         """Establish connection to compression server"""
@@ -29,6 +89,64 @@ class CompressionMCPClient:
             print(f"Failed to connect: {e}")
             return False
     
+    def compress_text_sync(self, text: str, ratio: float = 0.5) -> Dict[str, Any]:
+        """
+        Compress text locally (mock mode) without going through the event loop
+        
+        Args:
+            text: Text to compress
+            ratio: Target compression ratio (0.1-1.0)
+            
+        Returns:
+            Dict with compressed text and metrics
+        """
+        # Hashing the key costs an encoded copy of the text on every call,
+        # about as much as the mock compression itself; the cache pays off
+        # for the real MCP path. Large inputs bypass it entirely.
+        use_cache = self.deterministic and len(text) <= _COMPRESS_CACHE_MAX_TEXT
+        if use_cache:
+            key = (blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).hexdigest(), ratio)
+            cached = self._compress_cache.get(key)
+            if cached is not None:
+                self._compress_cache.move_to_end(key)
+                return {**cached, 'timestamp': self._now_iso()}
+        
+        # Simulate compression
+        word_count = len(text.split())
+        target_words = int(word_count * ratio)
+        
+        # Simple mock compression (in reality, this would use LLM)
+        # Keep the first half of the sentences by cutting at the matching
+        # '. ' boundary instead of splitting and re-joining
+        keep = max(1, (text.count('. ') + 1) // 2)
+        cut = -2
+        for _ in range(keep):
+            cut = text.find('. ', cut + 2)
+            if cut == -1:
+                cut = len(text)
+                break
+        compressed = text[:cut] + '.'
+        orig_len = len(text)
+        comp_len = cut + 1
+        
+        result = {
+            'compressed_text': compressed,
+            'original_length': orig_len,
+            'compressed_length': comp_len,
+            'compression_ratio': comp_len / orig_len,
+            'timestamp': self._now_iso()
+        }
+        
+        if use_cache:
+            self._compress_cache[key] = result
+            self._compress_cache_chars += comp_len
+            while (len(self._compress_cache) > _COMPRESS_CACHE_SIZE
+                   or self._compress_cache_chars > _COMPRESS_CACHE_MAX_CHARS):
+                _, evicted = self._compress_cache.popitem(last=False)
+                self._compress_cache_chars -= evicted['compressed_length']
+            result = dict(result)
+        return result
+    
     async def compress_text(self, text: str, ratio: float = 0.5) -> Dict[str, Any]:
         """
         Compress text using intelligent summarization
@@ -41,64 +159,161 @@ class CompressionMCPClient:
             Dict with compressed text and metrics
         """
         if self.mock_mode:
-            # Simulate compression
-            word_count = len(text.split())
-            target_words = int(word_count * ratio)
-            
-            # Simple mock compression (in reality, this would use LLM)
-            sentences = text.split('. ')
-            compressed = '. '.join(sentences[:max(1, len(sentences)//2)]) + '.'
-            
-            return {
-                'compressed_text': compressed,
-                'original_length': len(text),
-                'compressed_length': len(compressed),
-                'compression_ratio': len(compressed) / len(text),
-                'timestamp': datetime.now().isoformat()
-            }
+            return self.compress_text_sync(text, ratio)
         else:
             # Real MCP call
             # return await call_mcp_tool('compress_text', {'text': text, 'ratio': ratio})
             pass
     
+    def get_compression_suggestions_sync(self, 
+                                         conversation: List[Dict], 
+                                         threshold: float = 0.7, 
+                                         incremental: bool = False) -> Dict[str, Any]:
+        """
+        Analyze conversation locally (mock mode) without going through the event loop
+        
+        Args:
+            conversation: Array of message objects
+            threshold: Relevance threshold (0-1)
+            incremental: Resume from the previous call on this same list,
+                scanning only messages appended since. Only valid if the
+                caller never edits, replaces or removes earlier messages.
+            
+        Returns:
+            Compression suggestions
+        """
+        seen, word_count, suggestions = 0, 0, []
+        if incremental:
+            cached = self._suggest_cache.get(id(conversation))
+            # Resume only if the messages seen last time still bracket the
+            # prefix; this also rejects a recycled id() on a different list
+            if (cached is not None and cached[0] <= len(conversation)
+                    and conversation[0] is cached[3]
+                    and conversation[cached[0] - 1] is cached[4]):
+                seen, word_count, suggestions = cached[0], cached[1], list(cached[2])
+        
+        # Approximate word count by spaces; scale once instead of per message
+        for msg in conversation[seen:]:
+            content = msg.get('content', '')
+            if content:
+                word_count += content.count(' ') + 1
+        total_tokens = word_count * 1.3
+        
+        start = max(0, seen - 10)
+        for i, msg in enumerate(conversation[start:-10], start):  # Keep last 10 messages
+            clen = len(msg.get('content', ''))
+            if clen > 500:
+                suggestions.append({
+                    'message_index': i,
+                    'reason': 'Long message',
+                    'potential_savings': clen * 0.5
+                })
+        
+        if incremental and conversation:
+            self._suggest_cache[id(conversation)] = (
+                len(conversation), word_count, suggestions, conversation[0], conversation[-1])
+            self._suggest_cache.move_to_end(id(conversation))
+            if len(self._suggest_cache) > _SUGGEST_CACHE_SIZE:
+                self._suggest_cache.popitem(last=False)
+        
+        return {
+            'total_tokens': int(total_tokens),
+            'suggestions': [dict(s) for s in suggestions],
+            'estimated_savings': sum(s['potential_savings'] for s in suggestions),
+            'timestamp': self._now_iso()
+        }
+    
     async def get_compression_suggestions(self, 
                                         conversation: List[Dict], 
-                                        threshold: float = 0.7) -> Dict[str, Any]:
+                                        threshold: float = 0.7, 
+                                        incremental: bool = False) -> Dict[str, Any]:
         """
         Analyze conversation and suggest what to compress
         
         Args:
             conversation: Array of message objects
             threshold: Relevance threshold (0-1)
+            incremental: Only scan messages appended since the previous call
+                on this same list (see get_compression_suggestions_sync)
             
         Returns:
             Compression suggestions
         """
         if self.mock_mode:
-            # Analyze conversation for compression opportunities
-            total_tokens = sum(len(msg.get('content', '').split()) * 1.3 for msg in conversation)
-            
-            suggestions = []
-            for i, msg in enumerate(conversation[:-10]):  # Keep last 10 messages
-                if len(msg.get('content', '')) > 500:
-                    suggestions.append({
-                        'message_index': i,
-                        'reason': 'Long message',
-                        'potential_savings': len(msg['content']) * 0.5
-                    })
-            
-            return {
-                'total_tokens': int(total_tokens),
-                'suggestions': suggestions,
-                'estimated_savings': sum(s['potential_savings'] for s in suggestions),
-                'timestamp': datetime.now().isoformat()
-            }
+            return self.get_compression_suggestions_sync(conversation, threshold, incremental)
         else:
             # Real MCP call
             # return await call_mcp_tool('get_compression_suggestions', 
             #                          {'conversation': conversation, 'threshold': threshold})
             pass
     
+    def compress_conversation_soa(self, 
+                                  contents: Iterable[str], 
+                                  roles: Optional[List[str]] = None, 
+                                  max_tokens: int = 1000, 
+                                  message_count: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Compress a conversation given as parallel lists of contents and roles
+        
+        Args:
+            contents: Message contents, one string per message; may be a
+                lazy iterable, which stops being consumed once enough key
+                points and decisions are found
+            roles: Message roles, parallel to contents (optional)
+            max_tokens: Maximum tokens in result
+            message_count: Number of messages, required if contents has no len()
+            
+        Returns:
+            Compressed conversation
+        """
+        if message_count is None:
+            message_count = len(contents)
+        
+        # Extract key points from conversation
+        key_points = []
+        decisions = []
+        entities = []
+        
+        for content in contents:
+            if not _KEYWORD_RE.search(content):
+                continue  # Most messages match no keyword at all
+            # Simple extraction (real version would use LLM)
+            if len(decisions) < _MAX_DECISIONS and _DECISION_RE.search(content):
+                decisions.append(content[:100] + '...')
+            if len(key_points) < _MAX_KEY_POINTS and _ACTION_RE.search(content):
+                key_points.append(content[:100] + '...')
+            if len(decisions) >= _MAX_DECISIONS and len(key_points) >= _MAX_KEY_POINTS:
+                break  # Both lists are full, nothing more to collect
+        
+        compressed = {
+            'summary': f"Conversation with {message_count} messages",
+            'key_points': key_points,
+            'decisions': decisions,
+            'message_count': message_count,
+            'compression_ratio': 0.1,
+            'timestamp': self._now_iso()
+        }
+        
+        return compressed
+    
+    def compress_conversation_sync(self, 
+                                   messages: List[Dict], 
+                                   max_tokens: int = 1000) -> Dict[str, Any]:
+        """
+        Compress conversation locally (mock mode) without going through the event loop
+        
+        Args:
+            messages: Array of conversation messages
+            max_tokens: Maximum tokens in result
+            
+        Returns:
+            Compressed conversation
+        """
+        # A generator keeps the early exit once the result caps are reached
+        contents = (msg.get('content', '') for msg in messages)
+        return self.compress_conversation_soa(
+            contents, max_tokens=max_tokens, message_count=len(messages))
+    
     async def compress_conversation(self, 
                                   messages: List[Dict], 
                                   max_tokens: int = 1000) -> Dict[str, Any]:
@@ -113,29 +328,7 @@ class CompressionMCPClient:
             Compressed conversation
         """
         if self.mock_mode:
-            # Extract key points from conversation
-            key_points = []
-            decisions = []
-            entities = []
-            
-            for msg in messages:
-                content = msg.get('content', '')
-                # Simple extraction (real version would use LLM)
-                if 'decision' in content.lower() or 'decided' in content.lower():
-                    decisions.append(content[:100] + '...')
-                if any(word in content.lower() for word in ['implement', 'build', 'create']):
-                    key_points.append(content[:100] + '...')
-            
-            compressed = {
-                'summary': f"Conversation with {len(messages)} messages",
-                'key_points': key_points[:5],
-                'decisions': decisions[:3],
-                'message_count': len(messages),
-                'compression_ratio': 0.1,
-                'timestamp': datetime.now().isoformat()
-            }
-            
-            return compressed
+            return self.compress_conversation_sync(messages, max_tokens)
         else:
             # Real MCP call
             # return await call_mcp_tool('compress_conversation', 
@@ -147,10 +340,17 @@ class CompressionMCPClient:
         return {
             'connected': self.connected,
             'mock_mode': self.mock_mode,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': self._now_iso()
         }
 
 
+def _to_json(obj: Any) -> str:
+    """Pretty-print obj as JSON, using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(obj, indent=2)
+
+
 # Example usage
 if __name__ == "__main__":
     async def test_client():
@@ -160,7 +360,7 @@ if __name__ == "__main__":
         # Test compression
         test_text = "This is a very long text that needs to be compressed. " * 10
         result = await client.compress_text(test_text, ratio=0.3)
-        print(f"Compression result: {json.dumps(result, indent=2)}")
+        print(f"Compression result: {_to_json(result)}")
         
         # Test conversation compression
         test_conversation = [
@@ -168,6 +368,6 @@ if __name__ == "__main__":
             {"role": "assistant", "content": "I'll help you build it step by step"},
         ]
         suggestions = await client.get_compression_suggestions(test_conversation)
-        print(f"Suggestions: {json.dumps(suggestions, indent=2)}")
+        print(f"Suggestions: {_to_json(suggestions)}")
     
     asyncio.run(test_client())
@@ -5,27 +5,149 @@ Purpose: Diagnose MCP execution issues without shell commands
 """
 
 import os
+import re
 import sys
 import json
-import psutil
+import time
+import tempfile
 import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib json module
+    orjson = None
+
+_config_paths = None  # Built on first use, see _get_config_paths()
+
+# Shortest CPU sampling window (seconds) for a meaningful cpu_percent reading
+_MIN_CPU_SAMPLE = 0.1
+
+psutil = None  # Imported on first use, see _load_psutil()
+
+
+def _dumps(obj, depth=0):
+    """Serialize obj as indented JSON bytes, nested `depth` levels deep"""
+    # orjson writes non-ASCII text as raw UTF-8 where the stdlib fallback
+    # writes \uXXXX escapes; both parse to the same report. orjson rejects
+    # lone surrogates (e.g. from undecodable cmdlines), so those use the
+    # stdlib path.
+    data = None
+    if orjson is not None:
+        try:
+            data = orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    if data is None:
+        data = json.dumps(obj, indent=2).encode()
+    # Newlines inside JSON strings are escaped, so this only re-indents structure
+    return data.replace(b'\n', b'\n' + b'  ' * depth) if depth else data
+
+
+def _cpu_percent_between(t1, t2):
+    """Overall CPU utilization between two psutil.cpu_times() snapshots"""
+    # Same accounting as psutil.cpu_percent: guest time is already counted
+    # in user/nice, and idle plus iowait is not busy time
+    def totals(t):
+        total = sum(t) - getattr(t, 'guest', 0) - getattr(t, 'guest_nice', 0)
+        return total, total - t.idle - getattr(t, 'iowait', 0)
+    
+    total1, busy1 = totals(t1)
+    total2, busy2 = totals(t2)
+    if busy2 <= busy1:
+        return 0.0
+    if total2 <= total1:
+        return 100.0
+    return round(min(100.0, (busy2 - busy1) / (total2 - total1) * 100), 1)
+
+
+def _get_config_paths():
+    """Known Claude Desktop config locations as (Path, str) pairs"""
+    # Resolved lazily: Path.home() raises if the home directory is unknown,
+    # which must not break importing this module
+    global _config_paths
+    if _config_paths is None:
+        home = Path.home()
+        paths = [
+            home / "Library/Application Support/Claude/claude_desktop_config.json",
+            home / ".config/claude/claude_desktop_config.json",
+            home / "AppData/Roaming/Claude/claude_desktop_config.json"
+        ]
+        _config_paths = [(path, str(path)) for path in paths]
+    return _config_paths
+
+
+def _load_psutil():
+    """Import psutil lazily so importing this module stays cheap"""
+    global psutil
+    if psutil is None:
+        import psutil as _psutil
+        psutil = _psutil
+    return psutil
+
 
 class MCPDiagnostic:
+    __slots__ = ('report', '_platform', '_mcp_re', '_output', '_cpu_times',
+                 '_cpu_sampled_at')
+    
     def __init__(self):
+        self._platform = (platform.system(), platform.release())
         self.report = {
             'timestamp': datetime.now().isoformat(),
-            'platform': platform.system(),
+            'platform': self._platform[0],
             'python_version': sys.version,
             'checks': {}
         }
+        self._mcp_re = re.compile(r'mcp|claude|node', re.IGNORECASE)
+        self._output = threading.local()  # Per-thread buffer, see _say()
+        
+        # Snapshot CPU times now so check_system_resources can report
+        # utilization since construction instead of blocking for it. The
+        # snapshot is kept here rather than relying on psutil's own
+        # cpu_percent baseline, which is per thread. Any failure is left for
+        # check_system_resources to retry and record as a check error.
+        try:
+            self._cpu_times = _load_psutil().cpu_times()
+            self._cpu_sampled_at = time.monotonic()
+        except Exception:
+            self._cpu_times = None
+            self._cpu_sampled_at = None
+    
+    def _say(self, message):
+        """Print message, or buffer it if the check runs under _run_buffered"""
+        lines = getattr(self._output, 'lines', None)
+        if lines is None:
+            print(message)
+        else:
+            lines.append(message)
+    
+    def _run_buffered(self, check):
+        """Run check, returning the lines it would have printed"""
+        self._output.lines = lines = []
+        try:
+            check()
+        finally:
+            self._output.lines = None
+        return lines
     
     def check_system_resources(self):
         """Check CPU and memory usage"""
         try:
-            cpu_percent = psutil.cpu_percent(interval=1)
+            _load_psutil()
+            if self._cpu_times is None:
+                self._cpu_times = psutil.cpu_times()
+                self._cpu_sampled_at = time.monotonic()
+            elapsed = time.monotonic() - self._cpu_sampled_at
+            if elapsed < _MIN_CPU_SAMPLE:
+                time.sleep(_MIN_CPU_SAMPLE - elapsed)
+            cpu_times = psutil.cpu_times()
+            cpu_percent = _cpu_percent_between(self._cpu_times, cpu_times)
+            # The next call measures from this reading
+            self._cpu_times = cpu_times
+            self._cpu_sampled_at = time.monotonic()
             memory = psutil.virtual_memory()
             disk = psutil.disk_usage('/')
             
@@ -39,9 +161,9 @@ class MCPDiagnostic:
             
             # Check if resources are critically low
             if memory.percent > 90:
-                print("⚠️  WARNING: Memory usage is critically high!")
+                self._say("⚠️  WARNING: Memory usage is critically high!")
             if disk.percent > 95:
-                print("⚠️  WARNING: Disk space is critically low!")
+                self._say("⚠️  WARNING: Disk space is critically low!")
                 
         except Exception as e:
             self.report['checks']['resources'] = {'error': str(e)}
@@ -49,15 +171,21 @@ class MCPDiagnostic:
     def check_mcp_processes(self):
         """Find MCP-related processes"""
         try:
+            _load_psutil()
             mcp_processes = []
-            for proc in psutil.process_iter(['pid', 'name', 'cmdline', 'status']):
+            for pid in psutil.pids():
                 try:
-                    cmdline = ' '.join(proc.info['cmdline'] or [])
-                    if any(keyword in cmdline.lower() for keyword in ['mcp', 'claude', 'node']):
+                    # Read only the cmdline first; name and status are fetched
+                    # for matching processes only
+                    proc = psutil.Process(pid)
+                    cmdline = ' '.join(proc.cmdline())
+                    if not cmdline:
+                        continue  # Kernel threads have no cmdline
+                    if self._mcp_re.search(cmdline):
                         mcp_processes.append({
-                            'pid': proc.info['pid'],
-                            'name': proc.info['name'],
-                            'status': proc.info['status'],
+                            'pid': pid,
+                            'name': proc.name(),
+                            'status': proc.status(),
                             'cmdline': cmdline[:200]  # Truncate long commands
                         })
                 except (psutil.NoSuchProcess, psutil.AccessDenied):
@@ -68,71 +196,66 @@ class MCPDiagnostic:
             # Check for zombie processes
             zombies = [p for p in mcp_processes if p['status'] == 'zombie']
             if zombies:
-                print(f"⚠️  WARNING: Found {len(zombies)} zombie processes!")
+                self._say(f"⚠️  WARNING: Found {len(zombies)} zombie processes!")
                 
         except Exception as e:
             self.report['checks']['mcp_processes'] = {'error': str(e)}
     
     def check_mcp_config(self):
         """Check MCP configuration files"""
-        config_paths = [
-            Path.home() / "Library/Application Support/Claude/claude_desktop_config.json",
-            Path.home() / ".config/claude/claude_desktop_config.json",
-            Path.home() / "AppData/Roaming/Claude/claude_desktop_config.json"
-        ]
-        
-        for path in config_paths:
-            if path.exists():
+        for path, path_str in _get_config_paths():
+            if os.path.isfile(path_str):
                 try:
                     with open(path, 'r') as f:
                         config = json.load(f)
                     
                     self.report['checks']['mcp_config'] = {
-                        'path': str(path),
+                        'path': path_str,
                         'exists': True,
                         'server_count': len(config.get('mcpServers', {})),
                         'servers': list(config.get('mcpServers', {}).keys())
                     }
                     
-                    print(f"✅ Found MCP config at: {path}")
-                    print(f"   Configured servers: {', '.join(config.get('mcpServers', {}).keys())}")
+                    self._say(f"✅ Found MCP config at: {path}")
+                    self._say(f"   Configured servers: {', '.join(config.get('mcpServers', {}).keys())}")
                     break
                     
                 except Exception as e:
                     self.report['checks']['mcp_config'] = {
-                        'path': str(path),
+                        'path': path_str,
                         'exists': True,
                         'error': str(e)
                     }
         else:
             self.report['checks']['mcp_config'] = {'exists': False}
-            print("❌ No MCP configuration file found!")
+            self._say("❌ No MCP configuration file found!")
     
     def check_permissions(self):
         """Check file system permissions"""
         try:
-            test_dir = Path.home() / ".mcp_test"
-            test_file = test_dir / "test.txt"
+            home = Path.home()
+            readable = os.access(home, os.R_OK)
+            writable = os.access(home, os.W_OK)
             
-            # Try to create directory and file
-            test_dir.mkdir(exist_ok=True)
-            test_file.write_text("test")
-            content = test_file.read_text()
-            
-            # Clean up
-            test_file.unlink()
-            test_dir.rmdir()
+            # os.access can be wrong on network mounts, so confirm with a real write
+            if writable:
+                with tempfile.NamedTemporaryFile(dir=home, prefix='.mcp_test') as f:
+                    f.write(b'x')
+                    f.flush()
             
             self.report['checks']['permissions'] = {
-                'can_create_dirs': True,
-                'can_write_files': True,
-                'can_read_files': True
+                'can_create_dirs': writable,
+                'can_write_files': writable,
+                'can_read_files': readable
             }
-            print("✅ File system permissions OK")
+            if readable and writable:
+                self._say("✅ File system permissions OK")
+            else:
+                self._say("❌ File system permission issues detected!")
             
         except Exception as e:
             self.report['checks']['permissions'] = {'error': str(e)}
-            print("❌ File system permission issues detected!")
+            self._say("❌ File system permission issues detected!")
     
     def generate_recovery_suggestions(self):
         """Generate specific recovery suggestions based on findings"""
@@ -161,18 +284,54 @@ class MCPDiagnostic:
         self.report['recovery_suggestions'] = suggestions
         return suggestions
     
+    def write_report(self, report_file):
+        """Write the report to disk one check at a time
+        
+        Only the serialization buffer is bounded by the largest check; the
+        check results themselves stay in self.report.
+        """
+        with open(report_file, 'wb') as f:
+            f.write(b'{')
+            for i, (key, value) in enumerate(self.report.items()):
+                f.write(b',\n  ' if i else b'\n  ')
+                f.write(_dumps(key) + b': ')
+                if key == 'checks' and value:
+                    f.write(b'{')
+                    for j, (name, result) in enumerate(value.items()):
+                        f.write(b',\n    ' if j else b'\n    ')
+                        f.write(_dumps(name) + b': ' + _dumps(result, depth=2))
+                    f.write(b'\n  }')
+                else:
+                    f.write(_dumps(value, depth=1))
+            f.write(b'\n}')
+    
     def run_diagnostics(self):
         """Run all diagnostic checks"""
         print("=== MCP Diagnostic Tool ===")
-        print(f"Platform: {platform.system()} {platform.release()}")
+        print(f"Platform: {self._platform[0]} {self._platform[1]}")
         print(f"Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         print("\nRunning diagnostics...\n")
         
-        # Run all checks
-        self.check_system_resources()
-        self.check_mcp_processes()
-        self.check_mcp_config()
-        self.check_permissions()
+        # Run all checks concurrently; they are I/O bound and each one
+        # writes only its own entry in self.report['checks']
+        checks = [
+            self.check_system_resources,
+            self.check_mcp_processes,
+            self.check_mcp_config,
+            self.check_permissions,
+        ]
+        with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+            futures = [executor.submit(self._run_buffered, check) for check in checks]
+            # Print each check's output in check order, not completion order
+            for future in futures:
+                for line in future.result():
+                    print(line)
+        
+        # Keep report keys in a stable order regardless of completion order
+        order = ['resources', 'mcp_processes', 'mcp_config', 'permissions']
+        self.report['checks'] = dict(sorted(
+            self.report['checks'].items(),
+            key=lambda item: order.index(item[0]) if item[0] in order else len(order)))
         
         # Generate suggestions
         suggestions = self.generate_recovery_suggestions()
@@ -186,8 +345,7 @@ class MCPDiagnostic:
         
         # Save report
         report_file = f"mcp_diagnostic_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        with open(report_file, 'w') as f:
-            json.dump(self.report, f, indent=2)
+        self.write_report(report_file)
         
         print(f"\n📄 Full report saved to: {report_file}")
         